@@ -1,54 +1,163 @@
 from enum import Enum
-import json
 import logging
 import os
+import random
+import threading
 import time
-from functools import cache
-from typing import Annotated, cast, Type
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, lru_cache
+from typing import Annotated, Callable, cast, Iterator, Type
 
+import orjson
 import pydantic
 import requests
 from requests.adapters import Retry, HTTPAdapter
 
 import google.api_core.exceptions
+import google.auth.exceptions
+import google.auth.transport.requests
+from google.cloud.aiplatform import initializer as aiplatform_initializer
 import vertexai
+from vertexai.language_models import TextEmbeddingModel
 from vertexai.preview.generative_models import GenerativeModel, Part, GenerationResponse
 import vertexai.preview.generative_models as generative_models
 
+import llm_cache
+
 MISTRAL_API_URL = "https://api.mistral.ai"
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
 AISTUDIO_API_KEY = os.getenv("AISTUDIO_API_KEY")
+AISTUDIO_MODEL_URL = (
+    "https://generativelanguage.googleapis.com/v1/models/gemini-1.0-pro"
+)
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 
 USE_VERTEX_AI = True
 
+# -002 is the first 1.0 revision that accepts system instructions.
+VERTEX_MODEL = "gemini-1.0-pro-002"
+# Cheaper, lower-latency tier for prompts that don't need the full model.
+VERTEX_FAST_MODEL = "gemini-1.5-flash-001"
+VERTEX_MAX_ATTEMPTS = 6
+# Requests beyond what the quota allows would just be rate limited, so
+# queue them here instead.
+VERTEX_MAX_INFLIGHT = int(os.getenv("VERTEX_MAX_INFLIGHT", "8"))
+# Requests per minute each process may send to Google; 0 means unlimited.
+GOOGLE_MAX_RPM = int(os.getenv("GOOGLE_MAX_RPM", "0"))
+GEN_BATCH_SIZE = 10
+MAX_CONCURRENT_BATCHES = 5
+VERTEX_GENERATION_CONFIG = {
+    "max_output_tokens": 2048,
+    "temperature": 0.9,
+    "top_p": 1,
+    "stop_sequences": ["--"],
+}
+VERTEX_SAFETY_SETTINGS = {
+    generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
+    generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+    generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
+    generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+}
+
+
+DATA_PATH = os.path.join(DIR_PATH, "data")
+
+
+def read_data_file(fname):
+    with open(os.path.join(DATA_PATH, fname)) as f:
+        return f.read()
+
+
+# The data directory ships with the server, so load it all up front rather
+# than hitting the filesystem during the first request that needs a file.
+TEST_STRS = {
+    fname: read_data_file(fname)
+    for fname in os.listdir(DATA_PATH)
+    if fname.endswith(".txt")
+}
+TEST_JSONS = {
+    fname: orjson.loads(read_data_file(fname))
+    for fname in os.listdir(DATA_PATH)
+    if fname.endswith(".json")
+}
+
 
-@cache
 def get_test_str(fname):
-    with open(os.path.join(DIR_PATH, "data", fname)) as f:
-        return f.read()
+    if fname not in TEST_STRS:
+        TEST_STRS[fname] = read_data_file(fname)
+    return TEST_STRS[fname]
 
 
-@cache
 def get_test_json(fname):
-    with open(os.path.join(DIR_PATH, "data", fname)) as f:
-        return json.load(f)
+    if fname not in TEST_JSONS:
+        TEST_JSONS[fname] = orjson.loads(read_data_file(fname))
+    return TEST_JSONS[fname]
+
+
+class RateLimiter:
+    # Spaces calls evenly so a burst of generations queues here instead of
+    # tripping the provider's quota and sleeping through 429 backoff.
+    def __init__(self, per_minute: int):
+        self.interval = 60 / per_minute if per_minute else 0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
 
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        time.sleep(start - now)
 
-retry_strategy = Retry(
+
+google_rate_limiter = RateLimiter(GOOGLE_MAX_RPM)
+
+
+class GoogleRetry(Retry):
+    # urllib3 resends 429s and 5xxs inside the adapter, so each resend has
+    # to take its turn with the rate limiter as well.
+    def sleep(self, response=None):
+        super().sleep(response)
+        google_rate_limiter.wait()
+
+
+RETRY_OPTIONS = dict(
     total=4,
-    status_forcelist=[429, 500],
+    status_forcelist=[429, 500, 502, 503, 504],
+    respect_retry_after_header=True,
     backoff_factor=2,
     allowed_methods=frozenset(
         {"DELETE", "GET", "HEAD", "OPTIONS", "PUT", "TRACE", "POST"}
     ),
 )
-adapter = HTTPAdapter(max_retries=retry_strategy)
+# Keep connections to the (few) API hosts alive and let concurrent requests
+# from worker threads each get their own instead of blocking on the pool.
+adapter = HTTPAdapter(
+    pool_connections=4, pool_maxsize=32, max_retries=Retry(**RETRY_OPTIONS)
+)
+google_adapter = HTTPAdapter(
+    pool_connections=1, pool_maxsize=32, max_retries=GoogleRetry(**RETRY_OPTIONS)
+)
 
 session = requests.Session()
 session.mount("http://", adapter)
 session.mount("https://", adapter)
+session.mount("https://generativelanguage.googleapis.com/", google_adapter)
+# (connect, read) seconds. Without a timeout a stalled connection would hold
+# a worker forever instead of failing and being retried.
+REQUEST_TIMEOUT = (5, 60)
+
+vertex_slots = threading.BoundedSemaphore(VERTEX_MAX_INFLIGHT)
+
+
+@lru_cache(maxsize=32)
+def get_vertex_model(
+    model_name: str, system_instruction: str | None = None
+) -> GenerativeModel:
+    return GenerativeModel(model_name, system_instruction=system_instruction)
 
 
 class Color(str, Enum):
@@ -75,15 +184,14 @@ class Color(str, Enum):
     black = "black"
 
 
-def fix_color(v, handler, info):
-    try:
-        Color(v)
-    except ValueError:
-        v = "lightgray"
-    return handler(v)
+COLOR_VALUES = frozenset(c.value for c in Color)
+
+
+def fix_color(v):
+    return v if isinstance(v, str) and v in COLOR_VALUES else "lightgray"
 
 
-Color = Annotated[Color, pydantic.WrapValidator(fix_color)]
+Color = Annotated[Color, pydantic.BeforeValidator(fix_color)]
 
 
 class PokemonType(str, Enum):
@@ -107,15 +215,14 @@ class PokemonType(str, Enum):
     fairy = "fairy"
 
 
-def fix_type(v, handler, info):
-    try:
-        PokemonType(v)
-    except ValueError:
-        v = "normal"
-    return handler(v)
+POKEMON_TYPE_VALUES = frozenset(t.value for t in PokemonType)
+
+
+def fix_type(v):
+    return v if isinstance(v, str) and v in POKEMON_TYPE_VALUES else "normal"
 
 
-PokemonType = Annotated[PokemonType, pydantic.WrapValidator(fix_type)]
+PokemonType = Annotated[PokemonType, pydantic.BeforeValidator(fix_type)]
 
 
 class MapGen(str, Enum):
@@ -126,6 +233,8 @@ class MapGen(str, Enum):
 
 
 class Monster(pydantic.BaseModel):
+    model_config = pydantic.ConfigDict(use_enum_values=True)
+
     name: str
     char: str
     level: int
@@ -142,6 +251,8 @@ class Monster(pydantic.BaseModel):
 
 
 class Boss(pydantic.BaseModel):
+    model_config = pydantic.ConfigDict(use_enum_values=True)
+
     name: str
     char: str
     color: Color
@@ -156,6 +267,8 @@ class Boss(pydantic.BaseModel):
 
 
 class Area(pydantic.BaseModel):
+    model_config = pydantic.ConfigDict(use_enum_values=True)
+
     name: str
     blurb: str
     mapgen: MapGen
@@ -174,6 +287,8 @@ class ItemKind(str, Enum):
 
 
 class Item(pydantic.BaseModel):
+    model_config = pydantic.ConfigDict(use_enum_values=True)
+
     name: str
     level: int
     type: PokemonType
@@ -181,21 +296,34 @@ class Item(pydantic.BaseModel):
     kind: ItemKind
 
 
-def ask_mistral(prompt_parts: list[str]) -> str:
+def ask_mistral(
+    prompt_parts: list[str],
+    system_instruction: str | None = None,
+    is_valid: Callable[[str], bool] | None = None,
+) -> str:
     messages = [{"role": "user", "content": "".join(prompt_parts)}]
+    if system_instruction is not None:
+        messages.insert(0, {"role": "system", "content": system_instruction})
+    payload = {"model": "open-mixtral-8x7b", "messages": messages, "max_tokens": 2048}
+    cache_key = llm_cache.make_key("mistral", payload)
+    return llm_cache.get_or_call(cache_key, lambda: _ask_mistral(payload), is_valid)
+
+
+def _ask_mistral(payload: dict) -> str:
     headers = {
         "Content-Type": "application/json",
         "Accept": "application/json",
         "Authorization": f"Bearer {MISTRAL_API_KEY}",
     }
-    payload = {"model": "open-mixtral-8x7b", "messages": messages, "max_tokens": 2048}
     response = session.post(
         f"{MISTRAL_API_URL}/v1/chat/completions",
         headers=headers,
-        json=payload,
+        data=orjson.dumps(payload),
+        timeout=REQUEST_TIMEOUT,
     )
     response.raise_for_status()
-    return response.json()["choices"][0]["message"]["content"]
+    text = orjson.loads(response.content)["choices"][0]["message"]["content"]
+    return clean_response_text(text)
 
 
 def init_vertex_ai():
@@ -206,6 +334,13 @@ class AiError(Exception):
     pass
 
 
+def clean_response_text(text: str) -> str:
+    # Drop the "--" separator and any markdown code fence around the output.
+    text = text.strip().removeprefix("--").removesuffix("--").strip()
+    text = text.removeprefix("```json").removeprefix("```").removesuffix("```")
+    return text.strip()
+
+
 def get_safety_error(safety_ratings) -> AiError:
     safety_issues = []
     for rating in safety_ratings:
@@ -222,52 +357,113 @@ def get_safety_error(safety_ratings) -> AiError:
     raise AiError(", ".join(safety_issues))
 
 
-def ask_google_vertex_ai(prompt_parts: list[str]) -> str:
-    model = GenerativeModel("gemini-1.0-pro-001")
-    try:
-        responses = cast(
-            GenerationResponse,
-            model.generate_content(
-                "".join(prompt_parts),
-                generation_config={
-                    "max_output_tokens": 2048,
-                    "temperature": 0.9,
-                    "top_p": 1,
-                    "stop_sequences": ["--"],
-                },
-                safety_settings={
-                    generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
-                    generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-                    generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
-                    generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-                },
-                stream=False,
-            ),
-        )
-    except google.api_core.exceptions.ResourceExhausted as e:
-        logging.error(e)
-        time.sleep(1)
-        return ask_google_vertex_ai(prompt_parts)
-    try:
-        candidate = responses.candidates[0]
-        if candidate.finish_reason == generative_models.FinishReason.SAFETY:
-            logging.error(candidate)
-            raise get_safety_error(candidate.safety_ratings)
-        text = candidate.content.parts[0].text
-        text = text.strip("--")
-        logging.info(text)
-        return text
-    except KeyError:
-        logging.error(responses)
-        raise
-    except IndexError:
-        logging.error(responses)
-        raise
-
-
-def ask_google_ai_studio(prompt_parts: list[str]) -> str:
-    url = f"https://generativelanguage.googleapis.com/v1/models/gemini-1.0-pro:generateContent?key={AISTUDIO_API_KEY}"
-    headers = {"Content-Type": "application/json"}
+def ask_google_vertex_ai(
+    prompt_parts: list[str],
+    system_instruction: str | None = None,
+    max_lines: int | None = None,
+    vertex_model: str = VERTEX_MODEL,
+    is_valid: Callable[[str], bool] | None = None,
+) -> str:
+    prompt = "".join(prompt_parts)
+    cache_key = llm_cache.make_key(
+        "vertex",
+        vertex_model,
+        system_instruction,
+        prompt,
+        VERTEX_GENERATION_CONFIG,
+        max_lines,
+    )
+    return llm_cache.get_or_call(
+        cache_key,
+        lambda: _ask_google_vertex_ai(
+            prompt, system_instruction, max_lines, vertex_model
+        ),
+        is_valid,
+    )
+
+
+def _ask_google_vertex_ai(
+    prompt: str,
+    system_instruction: str | None,
+    max_lines: int | None,
+    vertex_model: str,
+) -> str:
+    model = get_vertex_model(vertex_model, system_instruction)
+    for attempt in range(VERTEX_MAX_ATTEMPTS):
+        try:
+            google_rate_limiter.wait()
+            with vertex_slots:
+                text = stream_vertex_text(model, prompt, max_lines)
+            break
+        except google.api_core.exceptions.ResourceExhausted as e:
+            logging.error(e)
+            if attempt == VERTEX_MAX_ATTEMPTS - 1:
+                raise
+            # Jitter keeps concurrent requests from retrying in lockstep.
+            time.sleep(min(60, 2**attempt) + random.random())
+    text = clean_response_text(text)
+    logging.info(text)
+    return text
+
+
+def stream_vertex_text(
+    model: GenerativeModel, prompt: str, max_lines: int | None
+) -> str:
+    responses = cast(
+        Iterator[GenerationResponse],
+        model.generate_content(
+            prompt,
+            generation_config=VERTEX_GENERATION_CONFIG,
+            safety_settings=VERTEX_SAFETY_SETTINGS,
+            stream=True,
+        ),
+    )
+    text = ""
+    for response in responses:
+        try:
+            candidate = response.candidates[0]
+            if candidate.finish_reason == generative_models.FinishReason.SAFETY:
+                logging.error(candidate)
+                raise get_safety_error(candidate.safety_ratings)
+            if candidate.content.parts:
+                text += candidate.content.parts[0].text
+        except (IndexError, KeyError):
+            logging.error(response)
+            raise
+        # Stop generating once the caller has all the lines it asked
+        # for, rather than paying for output that would be discarded.
+        if has_all_lines(text, max_lines):
+            responses.close()
+            text = text[: text.rindex("\n")]
+            break
+    return text
+
+
+def has_all_lines(text: str, max_lines: int | None) -> bool:
+    # Only complete lines holding a JSON object count, so a preamble, separator
+    # or code fence before the output can't end the stream early.
+    if max_lines is None or max_lines < 1:
+        return False
+    num_lines = sum(
+        1
+        for line in text.split("\n")[:-1]
+        if line.strip().startswith("{") and line.strip().endswith("}")
+    )
+    return num_lines >= max_lines
+
+
+# Takes the same arguments as ask_google_vertex_ai so either can be ask_google.
+# AI Studio has a fixed model URL, so vertex_model is ignored.
+def ask_google_ai_studio(
+    prompt_parts: list[str],
+    system_instruction: str | None = None,
+    max_lines: int | None = None,
+    vertex_model: str = VERTEX_MODEL,
+    is_valid: Callable[[str], bool] | None = None,
+) -> str:
+    # The v1 API has no system instructions, so send it as the first part.
+    if system_instruction is not None:
+        prompt_parts = [system_instruction, *prompt_parts]
     payload = {
         "contents": [
             {
@@ -282,159 +478,353 @@ def ask_google_ai_studio(prompt_parts: list[str]) -> str:
             "stopSequences": ["--"],
         },
     }
-    response = session.post(url, headers=headers, json=payload)
-    response.raise_for_status()
+    cache_key = llm_cache.make_key("ai_studio", AISTUDIO_MODEL_URL, payload, max_lines)
+    return llm_cache.get_or_call(
+        cache_key, lambda: _ask_google_ai_studio(payload, max_lines), is_valid
+    )
+
+
+def _ask_google_ai_studio(payload: dict, max_lines: int | None) -> str:
+    url = f"{AISTUDIO_MODEL_URL}:streamGenerateContent?alt=sse&key={AISTUDIO_API_KEY}"
+    headers = {"Content-Type": "application/json"}
+    google_rate_limiter.wait()
+    text = ""
+    with session.post(
+        url,
+        headers=headers,
+        data=orjson.dumps(payload),
+        timeout=REQUEST_TIMEOUT,
+        stream=True,
+    ) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line.startswith(b"data:"):
+                continue
+            chunk = orjson.loads(line.removeprefix(b"data:"))
+            try:
+                candidate = chunk["candidates"][0]
+                if candidate.get("finishReason") == "SAFETY":
+                    logging.error(candidate)
+                    raise AiError("blocked for safety")
+                for part in candidate.get("content", {}).get("parts", []):
+                    text += part["text"]
+            except (IndexError, KeyError):
+                logging.error(chunk)
+                raise
+            # Closing the response early cancels the rest of the generation.
+            if has_all_lines(text, max_lines):
+                text = text[: text.rindex("\n")]
+                break
+    text = clean_response_text(text)
+    logging.info(text)
+    return text
+
+
+ask_google = ask_google_vertex_ai if USE_VERTEX_AI else ask_google_ai_studio
+
+
+def ask_llm(
+    prompt_parts: list[str],
+    system_instruction: str | None = None,
+    max_lines: int | None = None,
+    vertex_model: str = VERTEX_MODEL,
+    is_valid: Callable[[str], bool] | None = None,
+) -> str:
     try:
-        text = response.json()["candidates"][0]["content"]["parts"][0]["text"]
-        text = text.strip("--")
-        logging.info(text)
-        return text
-    except (IndexError, KeyError):
-        logging.error(response.json())
-        raise
+        return ask_google(
+            prompt_parts, system_instruction, max_lines, vertex_model, is_valid
+        )
+    except (google.api_core.exceptions.GoogleAPIError, requests.RequestException) as e:
+        # Rather than failing the whole generation when Google is rate limiting
+        # or down, have Mistral answer instead if it's configured.
+        if MISTRAL_API_KEY is None:
+            raise
+        logging.error(f"Google request failed, falling back to Mistral: {e}")
+        return ask_mistral(prompt_parts, system_instruction, is_valid)
 
 
-def ask_google(prompt_parts: list[str]):
-    if USE_VERTEX_AI:
-        return ask_google_vertex_ai(prompt_parts)
-    else:
-        return ask_google_ai_studio(prompt_parts)
+EMBEDDING_MODEL = "text-embedding-004"
+
+
+@cache
+def embedding_model() -> TextEmbeddingModel:
+    return TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
+
+
+def embed_text(text: str) -> list[float]:
+    return embedding_model().get_embeddings([text])[0].values
+
+
+semantic_cache = llm_cache.SemanticCache(embed_text)
+
+
+def ask_semantic_cached(static_prompt: str, input: str, ask: Callable[[], str]) -> str:
+    # Only the dynamic input is embedded; the static part has to match exactly.
+    # Meant for short free-text inputs like a theme, where a close match is an
+    # acceptable answer; not for inputs listing names the output must cover.
+    if not llm_cache.SEMANTIC_THRESHOLD or llm_cache.DISABLED:
+        return ask()
+    # Exact repeats are answered without paying for an embedding request.
+    key = llm_cache.make_key("semantic", static_prompt, input)
+    if (response_text := llm_cache.get(key)) is not None:
+        return response_text
+    # Vectors from different embedding models aren't comparable.
+    namespace = llm_cache.make_key(EMBEDDING_MODEL, static_prompt)
+    response_text, vector = semantic_cache.get(namespace, input)
+    if response_text is None:
+        response_text = ask()
+        semantic_cache.put(namespace, vector, response_text)
+    llm_cache.put(key, response_text)
+    return response_text
+
+
+@cache
+def schema_json(model: Type[pydantic.BaseModel]) -> str:
+    return orjson.dumps(model.model_json_schema()).decode()
+
+
+def format_examples(examples: list[tuple[dict, list[dict]]]) -> str:
+    parts = []
+    for ex_input, ex_outputs in examples:
+        ex_input = dict(ex_input)
+        ex_input["num_outputs"] = len(ex_outputs)
+        parts.append(orjson.dumps(ex_input).decode())
+        parts.append("\n")
+        for ex_output in ex_outputs:
+            parts.append(orjson.dumps(ex_output).decode())
+            parts.append("\n")
+        parts.append("--")
+    return "".join(parts)
+
+
+@cache
+def type_adapter(model: Type[pydantic.BaseModel]) -> pydantic.TypeAdapter:
+    return pydantic.TypeAdapter(model)
 
 
 def ask_google_structured(
     instructions: str,
-    examples: list[tuple[dict, list[dict]]],
+    examples: str,
     input: dict,
     num_outputs: int,
     model: Type[pydantic.BaseModel],
+    vertex_model: str = VERTEX_MODEL,
+    names: list[str] | None = None,
 ) -> list[dict]:
-    # Build prompt
-    prompt_parts = [instructions, "--"]
-    prompt_parts.append("Expected JSON schema of each output line: ")
-    prompt_parts.append(json.dumps(model.model_json_schema()))
-    prompt_parts.append("--")
-    for ex_input, ex_outputs in examples:
-        ex_input = dict(ex_input)
-        ex_input["num_outputs"] = len(ex_outputs)
-        prompt_parts.append(json.dumps(ex_input))
-        prompt_parts.append("\n")
-        for ex_output in ex_outputs:
-            prompt_parts.append(json.dumps(ex_output))
-            prompt_parts.append("\n")
-        prompt_parts.append("--")
+    # Build prompt. Everything but the input is the same across calls, so it
+    # goes in the system instruction where the provider can cache it.
+    # `examples` is a block rendered once by format_examples.
+    static_prompt = "".join(
+        [
+            instructions,
+            "--",
+            "Expected JSON schema of each output line: ",
+            schema_json(model),
+            "--",
+            examples,
+        ]
+    )
     input = dict(input)
     input["num_outputs"] = num_outputs
-    prompt_parts.append(json.dumps(input))
-    prompt_parts.append("\n")
+    input_json = orjson.dumps(input).decode()
+
+    def is_valid(text: str) -> bool:
+        # Only cache a response once it parses into every requested output.
+        # When specific names were asked for, they must all come back too;
+        # otherwise the client would retry the missing names and keep getting
+        # the same cached response.
+        output = parse_outputs(text, model, num_outputs)
+        if len(output) < num_outputs:
+            return False
+        return names is None or set(names) <= {x["name"] for x in output}
+
+    logging.debug("ASKING: %s%s", static_prompt, input_json)
+    # No semantic lookup here: the input is dominated by the setting and item
+    # lists, so requests for different names would embed almost identically.
+    response_text = ask_llm(
+        [input_json + "\n"],
+        system_instruction=static_prompt,
+        max_lines=num_outputs,
+        vertex_model=vertex_model,
+        is_valid=is_valid,
+    )
+    logging.info("RECEIVED: %s", response_text)
+    output = parse_outputs(response_text, model, num_outputs)
+    if len(output) < num_outputs:
+        logging.error(f"Expected {num_outputs} outputs, got {len(output)}")
+    return output
 
-    prompt = "".join(prompt_parts)
-    logging.debug(f"ASKING: {prompt}")
-    response_text = ask_google([prompt])
-    logging.info(f"RECEIVED: {response_text}")
-    responses = response_text.split("\n")
+
+def parse_outputs(
+    response_text: str, model: Type[pydantic.BaseModel], num_outputs: int
+) -> list[dict]:
     output = []
-    for response in responses:
+    adapter = type_adapter(model)
+    for response in response_text.splitlines():
+        if not response.strip():
+            continue
         try:
-            response_json = json.loads(response)
-            output.append(model(**response_json).model_dump())
-            prompt_parts.append(response_text)
+            output.append(adapter.dump_python(adapter.validate_json(response)))
         except Exception as e:
-            logging.error(f"Bad response: {response}: {e}")
+            logging.debug(f"Bad response: {response}: {e}")
+        if len(output) >= num_outputs:
+            break
     return output
 
 
+def gen_batched(
+    gen_batch: Callable[[list[str]], list[dict]], names: list[str]
+) -> list[dict]:
+    # Each name is generated independently, so split long lists into smaller
+    # requests that run at the same time instead of one long generation.
+    batches = [
+        names[i : i + GEN_BATCH_SIZE] for i in range(0, len(names), GEN_BATCH_SIZE)
+    ]
+    with ThreadPoolExecutor(MAX_CONCURRENT_BATCHES) as executor:
+        return [x for output in executor.map(gen_batch, batches) for x in output]
+
+
+@cache
+def monster_examples() -> str:
+    return format_examples(
+        [
+            (
+                {
+                    "theme": "Hollow Knight",
+                    "setting_desc": get_test_str("hk.txt"),
+                    "enemy_names": sorted(
+                        set(m["name"] for m in get_test_json("hk_monsters.json"))
+                    ),
+                },
+                get_test_json("hk_monsters.json"),
+            )
+        ]
+    )
+
+
 def gen_monsters(theme: str, setting_desc: str, names: list[str]):
     instructions = "You are the game master for a difficult permadeath roguelike. For each input theme and level, output JSON monster definitions. Valid types and attack types are pokemon types, i.e. one of: normal fire water electric grass ice fighting poison ground flying psychic bug rock ghost dragon dark steel fairy. Valid colors are: lightgray yellow gold orange pink red maroon green lime skyblue blue purple violet beige brown white magenta. Output fields include name, the name of the monster; level, a number between 1 and 3 indicating how powerful the monster is; char, the single character to represent it as; color, one of the valid colors above; type1, the pokemon type of the monster; type2, an optional second type; attack_type, the pokemon the creature attacks as; and description, a two sentence description of the monster, one sentence of narration or dialogue which occurs when the enemy sees the player, one sentence of narration which occurs when the enemy attacks the player, one sentence of dialogue or narration which occurs when the enemy dies, and whether or not the enemy performs ranged attacks, and a number from 1 to 3 indicating how fast the enemy is. Output each monster JSON on its own line."
-    examples = [
-        (
-            {
-                "theme": "Hollow Knight",
-                "setting_desc": get_test_str("hk.txt"),
-                "enemy_names": list(
-                    set(m["name"] for m in get_test_json("hk_monsters.json"))
-                ),
-            },
-            get_test_json("hk_monsters.json"),
+
+    def gen_batch(batch: list[str]) -> list[dict]:
+        input = {"theme": theme, "setting_desc": setting_desc, "enemy_names": batch}
+        return ask_google_structured(
+            instructions,
+            monster_examples(),
+            input,
+            len(batch),
+            Monster,
+            vertex_model=VERTEX_FAST_MODEL,
+            names=batch,
         )
-    ]
-    input = {"theme": theme, "setting_desc": setting_desc, "enemy_names": names}
-    count = len(names)
-    return ask_google_structured(instructions, examples, input, count, Monster)
+
+    return gen_batched(gen_batch, sorted(set(names)))
+
+
+@cache
+def item_examples() -> str:
+    return format_examples(
+        [
+            (
+                {
+                    "theme": "Hollow Knight",
+                    "setting_desc": get_test_str("hk.txt"),
+                    "item_names": sorted(
+                        set(x["name"] for x in get_test_json("hk_items.json"))
+                    ),
+                },
+                get_test_json("hk_items.json"),
+            )
+        ]
+    )
 
 
 def gen_items(theme: str, setting_desc: str, names: list[str]):
     instructions = "You are the game master for a difficult permadeath roguelike. Output JSON item definitions for each given item name. Valid types are pokemon types, i.e. one of: normal fire water electric grass ice fighting poison ground flying psychic bug rock ghost dragon dark steel fairy. Output fields include name, the name of the item; level, a number between 1 and 3 indicating how powerful the item is; type, the pokemon type of the equipment or weapon; kind, indicating the kind of item, one of: melee_weapon ranged_weapon armor food; and description, a two sentence description of the item. Output each item JSON on its own line. DO NOT mention abilities or gameplay mechanics in the description; instead, focus on appearance or lore."
-    examples = [
-        (
-            {
-                "theme": "Hollow Knight",
-                "setting_desc": get_test_str("hk.txt"),
-                "item_names": list(
-                    set(x["name"] for x in get_test_json("hk_items.json"))
-                ),
-            },
-            get_test_json("hk_items.json"),
+    item_names = sorted(set(names))
+
+    def gen_batch(batch: list[str]) -> list[dict]:
+        input = {"theme": theme, "item_names": batch}
+        return ask_google_structured(
+            instructions, item_examples(), input, len(batch), Item, names=batch
         )
-    ]
-    item_names = list(set(name for name in names))
-    input = {"theme": theme, "item_names": item_names}
-    count = len(item_names)
-    return ask_google_structured(instructions, examples, input, count, Item)
 
+    return gen_batched(gen_batch, item_names)
 
+
+SETTING_DESC_INSTRUCTIONS = "Write a two paragraph setting description for a roguelike game based off of the following theme: {theme}. The game has three levels and features melee attacks, ranged attacks, and crafting. The description should describe the setting and discuss the kinds of monsters, items, the setting of each level, and the final boss."
+
+
+@llm_cache.memoize
 def gen_setting_desc(theme: str):
-    instructions = f"Write a two paragraph setting description for a roguelike game based off of the following theme: {theme}. The game has three levels and features melee attacks, ranged attacks, and crafting. The description should describe the setting and discuss the kinds of monsters, items, the setting of each level, and the final boss."
-    return ask_google([instructions])
+    instructions = SETTING_DESC_INSTRUCTIONS.format(theme=theme)
+    # Differently worded themes often want the same setting, so look for one.
+    return ask_semantic_cached(
+        SETTING_DESC_INSTRUCTIONS,
+        theme,
+        lambda: ask_llm([instructions], vertex_model=VERTEX_FAST_MODEL),
+    )
+
+
+@cache
+def area_examples() -> str:
+    return format_examples(
+        [
+            (
+                {
+                    "theme": "NetHack",
+                    "setting_desc": get_test_str("nethack.txt"),
+                },
+                get_test_json("nethack_areas.json"),
+            ),
+            (
+                {
+                    "theme": "Hollow Knight",
+                    "setting_desc": get_test_str("hk.txt"),
+                },
+                get_test_json("hk_areas.json"),
+            ),
+            (
+                {
+                    "theme": "Alien Isolation",
+                    "setting_desc": get_test_str("alien.txt"),
+                },
+                get_test_json("alien_areas.json"),
+            ),
+        ]
+    )
 
 
 def gen_areas(theme: str, setting_desc: str):
     instructions = f"You are the game master for a difficult permadeath roguelike. Based on the provided theme and high-level setting descriptions, produce JSON data describing the contents of each of the levels: name, blurb (a moody message presented to the user as they enter the level), mapgen (a string representing what map generation algorithm should be used for this level, one of: 'simple_rooms_and_corridors', 'caves', 'hive', or 'dense_rooms'), names of 20 possible enemies, names of 5 pieces of equipment (i.e. armor or accessories), names of 3 melee weapons, names of 2 ranged weapons, and names of 3 food items that may be found on that level. Make sure that all generated weapons, armor, monsters, and food are appropriate for the provided theme, try to avoid common or generic roguelike items. DO NOT generate the final boss; the final boss will be on a special fourth level. DO NOT generate the final boss level."
-    examples = [
-        (
-            {
-                "theme": "NetHack",
-                "setting_desc": get_test_str("nethack.txt"),
-            },
-            get_test_json("nethack_areas.json"),
-        ),
-        (
-            {
-                "theme": "Hollow Knight",
-                "setting_desc": get_test_str("hk.txt"),
-            },
-            get_test_json("hk_areas.json"),
-        ),
-        (
-            {
-                "theme": "Alien Isolation",
-                "setting_desc": get_test_str("alien.txt"),
-            },
-            get_test_json("alien_areas.json"),
-        ),
-    ]
     return ask_google_structured(
         instructions,
-        examples,
+        area_examples(),
         {"theme": theme, "setting_desc": setting_desc},
         3,
         Area,
     )
 
 
+@cache
+def boss_examples() -> str:
+    return format_examples(
+        [
+            (
+                {
+                    "theme": "Hollow Knight",
+                    "setting_desc": get_test_str("hk.txt"),
+                },
+                [get_test_json("hk_boss.json")],
+            )
+        ]
+    )
+
+
 def gen_boss(theme: str, setting_desc: str):
     instructions = f"You are the game master for a difficult permadeath roguelike. Based on the provided theme and high-level setting descriptions, produce JSON data describing the final boss of the game. The final boss is a slow enemy with a ranged attack that may appear with other monsters. Valid types and attack types are pokemon types, i.e. one of: normal fire water electric grass ice fighting poison ground flying psychic bug rock ghost dragon dark steel fairy. Valid colors are: lightgray yellow gold orange pink red maroon green lime skyblue blue purple violet beige brown white magenta. Output fields include name, the name of the boss; char, the single character to represent it as in-game; color, one of the valid colors above; type1, the pokemon type of the boss; type2, an optional second type; attack_type, the pokemon the creature attacks as; description, a two sentence description of the boss shown if clicked; intro_message, a message presented to the player when encountering the boss; attack_messages, a list of messages of which one will be randomly presented when the boss attacks the player with its ranged attack; periodic_messages, messages presented to the player randomly throughout the fight; and game_over_paragraph, a long-form message presented to the player when the boss is defeated and the game is won."
-    examples = [
-        (
-            {
-                "theme": "Hollow Knight",
-                "setting_desc": get_test_str("hk.txt"),
-            },
-            [get_test_json("hk_boss.json")],
-        )
-    ]
     return ask_google_structured(
         instructions,
-        examples,
+        boss_examples(),
         {
             "theme": theme,
             "setting_desc": setting_desc,
@@ -444,11 +834,20 @@ def gen_boss(theme: str, setting_desc: str):
     )[0]
 
 
+CRAFT_INSTRUCTIONS = "You are the game master for a difficult permadeath roguelike with a crafting system. The player may combine any two items in the game to create a third item, similar to Homestuck captchalogue code alchemy. As input, you will be given a theme, a long-form description of the setting, descriptions of each item, and a list of items already in the game (do not copy any of these). Output a JSON item definition for each weapon and equipment in the given game description. Valid types are pokemon types, i.e. one of: normal fire water electric grass ice fighting poison ground flying psychic bug rock ghost dragon dark steel fairy. DO NOT output multiple types. Output fields include name, the name of the item; level, a number indicating how powerful the weapon or equipment is; type, the pokemon type of the equipment or weapon; kind, the kind of item it is, one of: melee_weapon ranged_weapon armor food; and description, a two sentence description of the item. Output each item JSON on its own line. DO NOT reference gameplay mechanics that aren't in the game; instead, focus on appearance and lore. The two input items must be the same level; assign a level to the output item that is the level of each input item plus one; e.g. 2xL1->L2, 2xL2->L3, etc."
+
+
+def ordered_pair(item1: dict, item2: dict) -> tuple[dict, dict]:
+    # Crafting is commutative, so put the pair in a fixed order; A+B and B+A
+    # then send the same prompt and share a cache entry.
+    return (item1, item2) if item1["name"] <= item2["name"] else (item2, item1)
+
+
 def craft(theme: str, setting_desc: str, items: list[str], item1: dict, item2: dict):
-    instructions = f"You are the game master for a difficult permadeath roguelike with a crafting system. The player may combine any two items in the game to create a third item, similar to Homestuck captchalogue code alchemy. As input, you will be given a theme, a long-form description of the setting, descriptions of each item, and a list of items already in the game (do not copy any of these). Output a JSON item definition for each weapon and equipment in the given game description. Valid types are pokemon types, i.e. one of: normal fire water electric grass ice fighting poison ground flying psychic bug rock ghost dragon dark steel fairy. DO NOT output multiple types. Output fields include name, the name of the item; level, a number indicating how powerful the weapon or equipment is; type, the pokemon type of the equipment or weapon; kind, the kind of item it is, one of: melee_weapon ranged_weapon armor food; and description, a two sentence description of the item. Output each item JSON on its own line. DO NOT reference gameplay mechanics that aren't in the game; instead, focus on appearance and lore. The two input items must be the same level; assign a level to the output item that is the level of each input item plus one; e.g. 2xL1->L2, 2xL2->L3, etc."
+    item1, item2 = ordered_pair(item1, item2)
     return ask_google_structured(
-        instructions,
-        [],
+        CRAFT_INSTRUCTIONS,
+        "",
         {
             "theme": theme,
             "setting_desc": setting_desc,
@@ -461,5 +860,59 @@ def craft(theme: str, setting_desc: str, items: list[str], item1: dict, item2: d
     )[0]
 
 
+def craft_batch(
+    theme: str, setting_desc: str, items: list[str], pairs: list[tuple[dict, dict]]
+) -> list[dict]:
+    # Crafts several pairs in one request, sharing the prompt between them.
+    if not pairs:
+        return []
+    instructions = (
+        CRAFT_INSTRUCTIONS
+        + " The input contains a list of crafts, each with an item1 and an item2; output exactly one item per craft, in the same order as the crafts."
+    )
+    crafts = []
+    for pair in pairs:
+        item1, item2 = ordered_pair(*pair)
+        crafts.append({"item1": item1, "item2": item2})
+    crafted = ask_google_structured(
+        instructions,
+        "",
+        {
+            "theme": theme,
+            "setting_desc": setting_desc,
+            "existing_items": items,
+            "crafts": crafts,
+        },
+        len(pairs),
+        Item,
+    )
+    if len(crafted) != len(pairs):
+        raise AiError(f"expected {len(pairs)} crafted items, got {len(crafted)}")
+    return crafted
+
+
+def warm_connection(url: str):
+    # Do the DNS lookup and TLS handshake before the first real request.
+    try:
+        session.head(url, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        logging.warning(f"Couldn't warm connection to {url}: {e}")
+
+
+def warm_vertex_ai():
+    # The SDK fetches an access token on the first request; get it now. These
+    # are the credentials vertexai.init set up, shared by every client.
+    try:
+        credentials = aiplatform_initializer.global_config.credentials
+        credentials.refresh(google.auth.transport.requests.Request(session))
+    except (google.auth.exceptions.GoogleAuthError, requests.RequestException) as e:
+        logging.warning(f"Couldn't warm Vertex AI credentials: {e}")
+
+
 if USE_VERTEX_AI:
     init_vertex_ai()
+    threading.Thread(target=warm_vertex_ai, daemon=True).start()
+else:
+    threading.Thread(
+        target=warm_connection, args=(AISTUDIO_MODEL_URL,), daemon=True
+    ).start()
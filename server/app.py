@@ -1,23 +1,54 @@
 #!/usr/bin/env python
-import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
 
 import flask
 from flask import Flask, send_from_directory, jsonify
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
+import orjson
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.orm import DeclarativeBase
+from werkzeug.http import generate_etag
 from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.serving import is_running_from_reloader
 
 import v0
 import ai
+import llm_cache
 
 
-logging.basicConfig(level=logging.DEBUG)
+# Request/response logging is for development; production only wants errors.
+logging.basicConfig(
+    level=logging.WARNING
+    if os.environ.get("FLASK_ENV") == "production"
+    else logging.DEBUG
+)
+
+
+def log_json(obj):
+    # Skip serializing the whole response when INFO isn't being logged.
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info(orjson.dumps(obj).decode())
+
+
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Send orjson's bytes as-is rather than decoding them for dumps().
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # needed for running under reverse proxy
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
@@ -37,17 +68,6 @@ class Base(DeclarativeBase):
 def ai_error(e):
     return jsonify({'error': str(e)}), 500
 
-# Legacy 7drl version API
-app.add_url_rule(
-    "/setting/<path:theme>", view_func=v0.app.get_setting, methods=["POST"]
-)
-app.add_url_rule("/craft", view_func=v0.app.craft, methods=["POST"])
-app.add_url_rule("/areas", view_func=v0.app.get_areas, methods=["POST"])
-app.add_url_rule("/boss", view_func=v0.app.get_boss, methods=["POST"])
-app.add_url_rule("/monsters", view_func=v0.app.monsters, methods=["POST"])
-app.add_url_rule("/items", view_func=v0.app.items, methods=["POST"])
-
-
 @app.post("/v1/setting/<path:theme>")
 def get_setting_v1(theme):
     if theme == PREGEN_THEME:
@@ -59,11 +79,12 @@ def get_setting_v1(theme):
 
 @app.post("/v1/craft")
 def craft_v1():
-    theme = flask.request.get_json()["theme"]
-    setting_desc = flask.request.get_json()["setting"]
-    items = flask.request.get_json()["items"]
-    item1 = flask.request.get_json()["item1"]
-    item2 = flask.request.get_json()["item2"]
+    body = flask.request.get_json()
+    theme = body["theme"]
+    setting_desc = body["setting"]
+    items = body["items"]
+    item1 = body["item1"]
+    item2 = body["item2"]
     if theme == PREGEN_THEME:
         return {
             "name": "PREGEN",
@@ -74,68 +95,171 @@ def craft_v1():
         }
     else:
         new_item = ai.craft(theme, setting_desc, items, item1, item2)
-        logging.info(json.dumps(new_item))
+        log_json(new_item)
         return new_item
 
 
+@app.post("/v1/craft_batch")
+def craft_batch_v1():
+    body = flask.request.get_json()
+    theme = body["theme"]
+    setting_desc = body["setting"]
+    items = body["items"]
+    pairs = body["pairs"]
+    if theme == PREGEN_THEME:
+        return [
+            {
+                "name": "PREGEN",
+                "level": item1["level"] + 1,
+                "type": item1["type"],
+                "description": "who knows",
+                "kind": item1["kind"],
+            }
+            for item1, _ in pairs
+        ]
+    else:
+        new_items = ai.craft_batch(theme, setting_desc, items, pairs)
+        log_json(new_items)
+        return new_items
+
+
 @app.post("/v1/areas")
 def get_areas_v1():
-    theme = flask.request.get_json()["theme"]
-    setting_desc = flask.request.get_json()["setting"]
+    body = flask.request.get_json()
+    theme = body["theme"]
+    setting_desc = body["setting"]
     if theme == PREGEN_THEME:
         areas = ai.get_test_json("hk_areas.json")
     else:
         areas = ai.gen_areas(theme, setting_desc)
-    logging.info(json.dumps(areas))
+    log_json(areas)
     return areas
 
 
 @app.post("/v1/boss")
 def get_boss_v1():
-    theme = flask.request.get_json()["theme"]
-    setting_desc = flask.request.get_json()["setting"]
+    body = flask.request.get_json()
+    theme = body["theme"]
+    setting_desc = body["setting"]
     if theme == PREGEN_THEME:
         boss = ai.get_test_json("hk_boss.json")
     else:
         boss = ai.gen_boss(theme, setting_desc)
-    logging.info(json.dumps(boss))
+    log_json(boss)
     return boss
 
 
 @app.post("/v1/monsters")
 def monsters_v1():
-    theme = flask.request.get_json()["theme"]
-    setting_desc = flask.request.get_json()["setting"]
-    names = flask.request.get_json()["names"]
+    body = flask.request.get_json()
+    theme = body["theme"]
+    setting_desc = body["setting"]
+    names = body["names"]
     if theme == PREGEN_THEME:
         monsters = ai.get_test_json("hk_monsters.json")
     else:
         monsters = ai.gen_monsters(theme, setting_desc, names)
-    logging.info(json.dumps(monsters))
+    log_json(monsters)
     return monsters
 
 
 @app.post("/v1/items")
 def items_v1():
-    theme = flask.request.get_json()["theme"]
-    setting_desc = flask.request.get_json()["setting"]
-    names = flask.request.get_json()["names"]
+    body = flask.request.get_json()
+    theme = body["theme"]
+    setting_desc = body["setting"]
+    names = body["names"]
     if theme == PREGEN_THEME:
         items = ai.get_test_json("hk_items.json")
     else:
         items = ai.gen_items(theme, setting_desc, names)
-    logging.info(json.dumps(items))
+    log_json(items)
     return items
 
 
+@app.post("/v1/bootstrap")
+def bootstrap_v1():
+    # Everything a new game needs after the setting, in one request. The boss
+    # only needs the setting, so it generates alongside the areas, and the
+    # monsters and items are generated together once the areas name them.
+    body = flask.request.get_json()
+    theme = body["theme"]
+    setting_desc = body["setting"]
+    if theme == PREGEN_THEME:
+        return {
+            "areas": ai.get_test_json("hk_areas.json"),
+            "boss": ai.get_test_json("hk_boss.json"),
+            "monsters": ai.get_test_json("hk_monsters.json"),
+            "items": ai.get_test_json("hk_items.json"),
+        }
+    with ThreadPoolExecutor() as executor:
+        boss_future = executor.submit(ai.gen_boss, theme, setting_desc)
+        areas = ai.gen_areas(theme, setting_desc)
+        monster_names = [name for area in areas for name in area["enemies"]]
+        item_names = [
+            name
+            for area in areas
+            for kind in ["equipment", "melee_weapons", "ranged_weapons", "food"]
+            for name in area[kind]
+        ]
+        monsters_future = executor.submit(
+            ai.gen_monsters, theme, setting_desc, monster_names
+        )
+        items_future = executor.submit(ai.gen_items, theme, setting_desc, item_names)
+    game = {
+        "areas": areas,
+        "boss": boss_future.result(),
+        "monsters": monsters_future.result(),
+        "items": items_future.result(),
+    }
+    log_json(game)
+    return game
+
+
+@app.get("/v1/cache_stats")
+def cache_stats_v1():
+    # Counts are for the worker process that happens to serve the request.
+    return {"pid": os.getpid(), "hits": 0, "misses": 0, **llm_cache.stats}
+
+
+# Legacy 7drl version API. Only the area prompt differs from v1.
+app.add_url_rule(
+    "/setting/<path:theme>", view_func=get_setting_v1, methods=["POST"]
+)
+app.add_url_rule("/craft", view_func=craft_v1, methods=["POST"])
+app.add_url_rule("/areas", view_func=v0.app.get_areas, methods=["POST"])
+app.add_url_rule("/boss", view_func=get_boss_v1, methods=["POST"])
+app.add_url_rule("/monsters", view_func=monsters_v1, methods=["POST"])
+app.add_url_rule("/items", view_func=items_v1, methods=["POST"])
+
+
+# Built files aren't content-hashed, so only cache them briefly; after that
+# the browser revalidates with the ETag and usually gets a 304.
+STATIC_MAX_AGE = 3600
+
+
+@cache
+def index_html() -> tuple[bytes, str]:
+    # The body and its ETag, so neither is recomputed per request.
+    with open(os.path.join(app.root_path, "../dist/index.html"), "rb") as f:
+        body = f.read()
+    return body, generate_etag(body)
+
+
 @app.route("/")
 def root():
-    return send_from_directory("../dist", "index.html")
+    # Served from memory; the ETag still lets browsers revalidate with a 304.
+    body, etag = index_html()
+    response = flask.Response(body, mimetype="text/html")
+    response.cache_control.no_cache = True
+    response.cache_control.max_age = 0
+    response.set_etag(etag)
+    return response.make_conditional(flask.request)
 
 
 @app.route("/<path:path>")
 def serve_static(path):
-    return send_from_directory("../dist", path)
+    return send_from_directory("../dist", path, max_age=STATIC_MAX_AGE)
 
 
 print(f"Using database {app.config['SQLALCHEMY_DATABASE_URI']}")
@@ -0,0 +1,8 @@
+# Requests spend nearly all their time waiting on the LLM, so give each worker
+# a pool of threads instead of blocking it for one generation at a time.
+worker_class = "gthread"
+workers = 2
+threads = 32
+# No timeout override: with gthread workers it's only a heartbeat from the
+# worker's main loop, which keeps running while requests wait on the LLM, so
+# long generations aren't cut off by gunicorn's default 30 seconds.
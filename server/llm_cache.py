@@ -0,0 +1,208 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from functools import lru_cache
+from typing import Callable
+
+import numpy as np
+import orjson
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+
+CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH", os.path.join(DIR_PATH, "cache", "llm_cache.sqlite")
+)
+# Responses are sampled with temperature > 0, so set this to get fresh ones.
+DISABLED = bool(os.getenv("LLM_CACHE_DISABLE"))
+EXPIRE_SECONDS = 7 * 86400
+# Cosine similarity above which a semantically similar input counts as a hit.
+# Off unless set, since near-duplicate inputs can still warrant new outputs.
+SEMANTIC_THRESHOLD = float(os.getenv("LLM_SEMANTIC_CACHE_THRESHOLD", "0"))
+# Newest entries kept per semantic namespace; each lookup scans all of them.
+SEMANTIC_MAX_ENTRIES = 1000
+
+_local = threading.local()
+
+# Hit/miss counts for this process, for checking whether the cache is useful.
+stats: Counter[str] = Counter()
+
+_inflight: dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+
+def _connection() -> sqlite3.Connection:
+    # sqlite3 connections can't be shared across threads; keep one per thread.
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        conn = sqlite3.connect(CACHE_PATH, timeout=30)
+        # WAL lets readers in other gunicorn workers proceed during a write.
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Losing the last few writes on power loss is fine for a cache.
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache"
+            " (key TEXT PRIMARY KEY, response TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_cache"
+            " (namespace TEXT NOT NULL, embedding BLOB NOT NULL, response TEXT NOT NULL)"
+        )
+        # Expired rows are never read again; clear them out as each thread
+        # connects so the file doesn't grow forever.
+        with conn:
+            conn.execute("DELETE FROM llm_cache WHERE expires <= ?", (time.time(),))
+        _local.conn = conn
+    return conn
+
+
+def make_key(*parts) -> str:
+    blob = orjson.dumps(parts, option=orjson.OPT_SORT_KEYS, default=str)
+    return hashlib.sha256(blob).hexdigest()
+
+
+def get(key: str, is_valid: Callable[[str], bool] | None = None) -> str | None:
+    # Entries failing is_valid are treated (and counted) as misses.
+    if DISABLED:
+        return None
+    row = (
+        _connection()
+        .execute(
+            "SELECT response FROM llm_cache WHERE key = ? AND expires > ?",
+            (key, time.time()),
+        )
+        .fetchone()
+    )
+    response = row[0] if row is not None else None
+    if response is not None and is_valid is not None and not is_valid(response):
+        response = None
+    stats["hits" if response is not None else "misses"] += 1
+    return response
+
+
+def put(key: str, response: str, expire: float = EXPIRE_SECONDS):
+    if DISABLED:
+        return
+    with _connection() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)",
+            (key, response, time.time() + expire),
+        )
+
+
+def single_flight(key: str, fn: Callable[[], str]) -> str:
+    # Concurrent callers with the same key wait on the first caller's result
+    # instead of each making their own request.
+    with _inflight_lock:
+        future = _inflight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = _inflight[key] = Future()
+    if not is_leader:
+        return future.result()
+    try:
+        result = fn()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+def get_or_call(
+    key: str, fn: Callable[[], str], is_valid: Callable[[str], bool] | None = None
+) -> str:
+    # Responses failing is_valid are never served from or written to the cache,
+    # so one bad generation gets resampled on retry instead of repeated.
+    response = get(key, is_valid)
+    if response is not None:
+        return response
+
+    def call_and_put():
+        response = fn()
+        if is_valid is None or is_valid(response):
+            put(key, response)
+        return response
+
+    return single_flight(key, call_and_put)
+
+
+def memoize(fn):
+    # In-process layer over the persistent cache, for small results that are
+    # requested repeatedly. Cached results are shared, so don't mutate them.
+    return fn if DISABLED else lru_cache(maxsize=512)(fn)
+
+
+# Nearest-neighbour lookup over embeddings of previously seen inputs. Entries
+# are grouped by namespace (e.g. a hash of the static part of a prompt) so only
+# inputs to the same kind of request are compared.
+class SemanticCache:
+
+    def __init__(self, embed: Callable[[str], list[float]]):
+        self.embed = embed
+        self.lock = threading.Lock()
+        self.entries: dict[str, tuple[np.ndarray, list[str]]] = {}
+
+    def _load(self, namespace: str) -> tuple[np.ndarray, list[str]]:
+        if namespace not in self.entries:
+            rows = (
+                _connection()
+                .execute(
+                    "SELECT embedding, response FROM semantic_cache"
+                    " WHERE namespace = ? ORDER BY rowid DESC LIMIT ?",
+                    (namespace, SEMANTIC_MAX_ENTRIES),
+                )
+                .fetchall()[::-1]
+            )
+            vectors = [np.frombuffer(row[0], dtype=np.float32) for row in rows]
+            self.entries[namespace] = (
+                np.stack(vectors) if vectors else np.empty((0, 0), dtype=np.float32),
+                [row[1] for row in rows],
+            )
+        return self.entries[namespace]
+
+    def _vector(self, text: str) -> np.ndarray:
+        vector = np.asarray(self.embed(text), dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def get(self, namespace: str, text: str) -> tuple[str | None, np.ndarray]:
+        vector = self._vector(text)
+        with self.lock:
+            matrix, responses = self._load(namespace)
+            if not responses:
+                return None, vector
+            scores = matrix @ vector
+        best = int(np.argmax(scores))
+        if scores[best] >= SEMANTIC_THRESHOLD:
+            return responses[best], vector
+        return None, vector
+
+    def put(self, namespace: str, vector: np.ndarray, response: str):
+        with self.lock:
+            matrix, responses = self._load(namespace)
+            matrix = vector[None, :] if not responses else np.vstack([matrix, vector])
+            responses = responses + [response]
+            # Drop the oldest entries once the namespace is full.
+            self.entries[namespace] = (
+                matrix[-SEMANTIC_MAX_ENTRIES:],
+                responses[-SEMANTIC_MAX_ENTRIES:],
+            )
+        with _connection() as conn:
+            conn.execute(
+                "INSERT INTO semantic_cache VALUES (?, ?, ?)",
+                (namespace, vector.tobytes(), response),
+            )
+            conn.execute(
+                "DELETE FROM semantic_cache WHERE namespace = ? AND rowid NOT IN"
+                " (SELECT rowid FROM semantic_cache WHERE namespace = ?"
+                " ORDER BY rowid DESC LIMIT ?)",
+                (namespace, namespace, SEMANTIC_MAX_ENTRIES),
+            )
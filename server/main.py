@@ -1,16 +1,48 @@
 #!/usr/bin/env python
-import json
 import logging
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import click
+import orjson
 
 import ai
 
 
+def print_json(obj, indent: bool = True):
+    # Write orjson's bytes directly instead of decoding them for print().
+    sys.stdout.flush()
+    option = orjson.OPT_APPEND_NEWLINE
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    sys.stdout.buffer.write(orjson.dumps(obj, option=option))
+    sys.stdout.buffer.flush()
+
+
+def gen_until_complete(gen, names_needed: set[str], max_tries: int = 10) -> list:
+    # The LLM sometimes skips or renames a requested name, so ask again for
+    # whatever is still missing. A round with no progress usually got a full
+    # but renamed response, which is cached, so asking again wouldn't help.
+    results = []
+    for _ in range(max_tries):
+        if not names_needed:
+            break
+        logging.info("need %s", names_needed)
+        num_needed = len(names_needed)
+        for obj in gen(sorted(names_needed)):
+            results.append(obj)
+            names_needed.discard(obj["name"])
+        if len(names_needed) == num_needed:
+            break
+    if names_needed:
+        logging.warning("giving up on %s", sorted(names_needed))
+    return results
+
+
 @click.group()
 def cli():
-    logging.basicConfig(level=logging.DEBUG)
+    pass
 
 
 @cli.command()
@@ -21,10 +53,11 @@ def cli():
 @click.argument("item2")
 def craft(theme: str, setting_desc_file, items_file, item1: str, item2: str):
     setting_desc = setting_desc_file.read()
-    items = json.load(items_file)
-    item1_obj = next(x for x in items if x["name"] == item1)
-    item2_obj = next(x for x in items if x["name"] == item2)
-    print(json.dumps(ai.craft(theme, setting_desc, items, item1_obj, item2_obj)))
+    items = orjson.loads(items_file.read())
+    items_by_name = {x["name"]: x for x in items}
+    item1_obj = items_by_name[item1]
+    item2_obj = items_by_name[item2]
+    print_json(ai.craft(theme, setting_desc, items, item1_obj, item2_obj), indent=False)
 
 
 @cli.command()
@@ -48,7 +81,7 @@ def gen_setting_desc(theme: str):
 def gen_areas(theme: str, setting_desc_file):
     setting_desc = setting_desc_file.read()
     areas = ai.gen_areas(theme, setting_desc)
-    print(json.dumps(areas, indent=2))
+    print_json(areas)
 
 
 @cli.command()
@@ -57,16 +90,12 @@ def gen_areas(theme: str, setting_desc_file):
 @click.argument("areas_file", type=click.File("r"))
 def gen_monsters(theme: str, setting_desc_file, areas_file):
     setting_desc = setting_desc_file.read()
-    areas = json.load(areas_file)
+    areas = orjson.loads(areas_file.read())
     names_needed = set(m for area in areas for m in area["enemies"])
-    monsters = []
-    while names_needed:
-        logging.info(f"need {names_needed}")
-        for monster in ai.gen_monsters(theme, setting_desc, list(names_needed)):
-            monsters.append(monster)
-            if monster["name"] in names_needed:
-                names_needed.remove(monster["name"])
-    print(json.dumps(monsters, indent=2))
+    monsters = gen_until_complete(
+        lambda names: ai.gen_monsters(theme, setting_desc, names), names_needed
+    )
+    print_json(monsters)
 
 
 @cli.command()
@@ -75,23 +104,17 @@ def gen_monsters(theme: str, setting_desc_file, areas_file):
 @click.argument("areas_file", type=click.File("r"))
 def gen_items(theme: str, setting_desc_file, areas_file):
     setting_desc = setting_desc_file.read()
-    areas = json.load(areas_file)
-    names_needed = set(
-        name
-        for area in areas
-        for name in area["equipment"]
-        + area["melee_weapons"]
-        + area["ranged_weapons"]
-        + area["food"]
+    areas = orjson.loads(areas_file.read())
+    names_needed = set()
+    for area in areas:
+        names_needed.update(area["equipment"])
+        names_needed.update(area["melee_weapons"])
+        names_needed.update(area["ranged_weapons"])
+        names_needed.update(area["food"])
+    items = gen_until_complete(
+        lambda names: ai.gen_items(theme, setting_desc, names), names_needed
     )
-    items = []
-    while names_needed:
-        print("need", names_needed)
-        for item in ai.gen_items(theme, setting_desc, list(names_needed)):
-            items.append(item)
-            if item["name"] in names_needed:
-                names_needed.remove(item["name"])
-    print(json.dumps(items, indent=2))
+    print_json(items)
 
 
 @cli.command()
@@ -100,7 +123,7 @@ def gen_items(theme: str, setting_desc_file, areas_file):
 def gen_boss(theme: str, setting_desc_file):
     setting_desc = setting_desc_file.read()
     boss = ai.gen_boss(theme, setting_desc)
-    print(json.dumps(boss, indent=2))
+    print_json(boss)
 
 
 @cli.command()
@@ -113,17 +136,11 @@ def gen_all(theme: str, output_dir: str | None):
         with open(os.path.join(output_dir, "setting.txt"), "w") as f:
             f.write(setting_desc)
     areas = ai.gen_areas(theme, setting_desc)
-    print(json.dumps(areas, indent=2))
+    print_json(areas)
     if output_dir is not None:
-        with open(os.path.join(output_dir, "areas.json"), "w") as f:
-            json.dump(areas, f)
+        with open(os.path.join(output_dir, "areas.json"), "wb") as f:
+            f.write(orjson.dumps(areas))
     monster_names = set(name for area in areas for name in area["enemies"])
-    monsters = ai.gen_monsters(theme, setting_desc, list(monster_names))
-    print(json.dumps(monsters, indent=2))
-    if output_dir is not None:
-        with open(os.path.join(output_dir, "monsters.json"), "w") as f:
-            json.dump(monsters, f)
-
     item_names = set(
         name
         for area in areas
@@ -132,19 +149,37 @@ def gen_all(theme: str, output_dir: str | None):
         + area["ranged_weapons"]
         + area["food"]
     )
-    items = ai.gen_items(theme, setting_desc, list(item_names))
-    print(json.dumps(items, indent=2))
+    # Monsters, items and the boss only depend on the setting and areas, so
+    # request them all at once rather than waiting on each in turn.
+    with ThreadPoolExecutor() as executor:
+        monsters_future = executor.submit(
+            ai.gen_monsters, theme, setting_desc, sorted(monster_names)
+        )
+        items_future = executor.submit(
+            ai.gen_items, theme, setting_desc, sorted(item_names)
+        )
+        boss_future = executor.submit(ai.gen_boss, theme, setting_desc)
+
+    monsters = monsters_future.result()
+    print_json(monsters)
     if output_dir is not None:
-        with open(os.path.join(output_dir, "items.json"), "w") as f:
-            json.dump(items, f)
-    boss = ai.gen_boss(theme, setting_desc)
+        with open(os.path.join(output_dir, "monsters.json"), "wb") as f:
+            f.write(orjson.dumps(monsters))
+
+    items = items_future.result()
+    print_json(items)
+    if output_dir is not None:
+        with open(os.path.join(output_dir, "items.json"), "wb") as f:
+            f.write(orjson.dumps(items))
+    boss = boss_future.result()
     if output_dir is not None:
-        with open(os.path.join(output_dir, "boss.json"), "w") as f:
-            json.dump(boss, f)
-    print(json.dumps(boss, indent=2))
+        with open(os.path.join(output_dir, "boss.json"), "wb") as f:
+            f.write(orjson.dumps(boss))
+    print_json(boss)
 
 
 def main():
+    logging.basicConfig(level=os.getenv("LOGLEVEL", "DEBUG").upper())
     cli()
 
 